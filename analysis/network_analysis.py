@@ -1,6 +1,7 @@
 import logging
 from datetime import datetime
-from typing import Any, List
+from functools import lru_cache
+from typing import Any, List, Optional, Tuple
 
 import gilda
 import networkx as nx
@@ -17,6 +18,20 @@ logging.basicConfig(
 # Set the logging level of the elasticsearch module to WARNING
 es_logger.setLevel(logging.WARNING)
 
+INDEX_NAME = "pubmed-paper-index"
+
+# The only fields of the indexed documents that are used to build the models.
+SOURCE_FIELDS = ["pmid", "title", "mesh_annotations", "authors"]
+
+
+@lru_cache(maxsize=4096)
+def _ground_mesh(term: str) -> Optional[str]:
+    """Return the ID of the best MeSH grounding for a term, if there is one."""
+    scored_matches = gilda.ground(term, namespaces=["MESH"])
+    if not scored_matches:
+        return None
+    return scored_matches[0].term.id
+
 
 class Affiliation(BaseModel):
     """An affiliation with a name and list of identifiers."""
@@ -36,9 +51,10 @@ class Author(BaseModel):
     identifier: str | None
 
     papers: List["Paper"] = None
+    key: str = None
 
-    def key(self):
-        return f"{self.first_name} {self.last_name}"
+    def model_post_init(self, __context):
+        self.key = f"{self.first_name} {self.last_name}"
 
     def score(self):
         """Return the score of this author."""
@@ -53,9 +69,10 @@ class Paper(BaseModel):
     authors: List[Author] = None
     mesh_annotations: List[dict]
     score: float
+    key: str = None
 
-    def key(self):
-        return f"{self.pmid} {self.title}"
+    def model_post_init(self, __context):
+        self.key = f"{self.pmid} {self.title}"
 
 
 class Search:
@@ -80,52 +97,123 @@ class Search:
         If True, convert the search terms to MeSH terms where possible. Otherwise, search
         for the terms directly. Defaults to True. NOTE: Mapping to mesh terms can be a
         slow process, so setting this to False can speed up the search process considerably.
+    validate : bool
+        If True, validate the authors and papers returned by ElasticSearch as the models
+        are built. The indexed documents already match the models, so this is only useful
+        for debugging, and is off by default because validation is slow.
     """
 
-    def __init__(self, *search_terms: str, max_papers=100, ground_terms=True):
-        self.search_terms = search_terms
+    def __init__(
+        self, *search_terms: str, max_papers=100, ground_terms=True, validate=False
+    ):
+        self.__setup(search_terms, ground_terms, validate)
+        self.__search(max_papers=max_papers)
+
+    def __setup(
+        self, search_terms: Tuple[str, ...], ground_terms: bool, validate: bool
+    ):
+        """Set the attributes of a search, before it is run."""
+        self.search_terms = tuple(search_terms)
         self.ground_terms = ground_terms
+        self.validate = validate
         self.authors = None
         self.papers = None
         self.graph = None
 
-        self.__search(max_papers=max_papers)
+    @classmethod
+    def batch(
+        cls,
+        term_tuples: List[Tuple[str, ...]],
+        max_papers=100,
+        ground_terms=True,
+        validate=False,
+    ) -> List["Search"]:
+        """Run several searches with a single request to ElasticSearch.
+
+        This is equivalent to ``[Search(*terms) for terms in term_tuples]``, except
+        that the queries are all sent in one msearch request, rather than one round
+        trip per search.
+
+        >>> covid_search, cancer_search = Search.batch([("COVID-19",), ("cancer",)])
+        """
+        searches = []
+        msearch_body = []
+        for search_terms in term_tuples:
+            search = cls.__new__(cls)
+            search.__setup(search_terms, ground_terms, validate)
+            msearch_body.append({"index": INDEX_NAME})
+            msearch_body.append(
+                {
+                    "query": search._build_query(),
+                    "size": max_papers,
+                    "_source": SOURCE_FIELDS,
+                }
+            )
+            searches.append(search)
+
+        # Run all the searches against ElasticSearch at once
+        print(f"Running {len(searches)} searches...", end="", flush=True)
+        start_search = datetime.now()
+        es = get_es_client()
+        resp = es.msearch(searches=msearch_body)
+        print(f"done in {datetime.now() - start_search} seconds", flush=True)
+
+        if len(resp["responses"]) != len(searches):
+            raise ValueError(
+                f"Expected {len(searches)} search responses, but got "
+                f"{len(resp['responses'])}."
+            )
+        for search, search_resp in zip(searches, resp["responses"]):
+            if "error" in search_resp:
+                raise ValueError(
+                    f"Search for {search.search_terms} failed: {search_resp['error']}"
+                )
+            search._ingest_hits(search_resp["hits"]["hits"])
+        return searches
 
     def __search(self, max_papers=100):
         """Search for papers and authors matching the given terms."""
-        # Convert the terms we can to MeSH
-        print("Grounding terms...", end="", flush=True)
-        start_grounding = datetime.now()
-        match_query_terms = []
-        for term in self.search_terms:
-            if self.ground_terms and (
-                scored_matches := gilda.ground(term, namespaces=["MESH"])
-            ):
-                match_query_terms.append(
-                    {"match": {"mesh_annotations.mesh": scored_matches[0].term.id}}
-                )
-            else:
-                match_query_terms.append({"match": {"abstract": term}})
-        print(f"done in {datetime.now() - start_grounding} seconds", flush=True)
+        query = self._build_query()
 
         # Run the search against ElasticSearch
         print("Searching for papers...", end="", flush=True)
         start_search = datetime.now()
         es = get_es_client()
         resp = es.search(
-            index="pubmed-paper-index",
-            query={"bool": {"should": match_query_terms}},
+            index=INDEX_NAME,
+            query=query,
             size=max_papers,
+            source_includes=SOURCE_FIELDS,
         )
         print(f"done in {datetime.now() - start_search} seconds", flush=True)
 
+        self._ingest_hits(resp["hits"]["hits"])
+        return
+
+    def _build_query(self):
+        """Build the ElasticSearch query for the search terms."""
+        # Convert the terms we can to MeSH
+        print("Grounding terms...", end="", flush=True)
+        start_grounding = datetime.now()
+        match_query_terms = []
+        for term in self.search_terms:
+            if self.ground_terms and (mesh_id := _ground_mesh(term)):
+                match_query_terms.append({"match": {"mesh_annotations.mesh": mesh_id}})
+            else:
+                match_query_terms.append({"match": {"abstract": term}})
+        print(f"done in {datetime.now() - start_grounding} seconds", flush=True)
+        return {"bool": {"should": match_query_terms}}
+
+    def _ingest_hits(self, hits: List[dict]):
+        """Build the author and paper models, and their graph, from search hits."""
         # Convert the results into models for authors and papers
         print("Building models...", end="", flush=True)
         start_models = datetime.now()
         self.authors = {}
         self.papers = {}
-        for hit in resp["hits"]["hits"]:
-            paper = Paper(
+        for hit in hits:
+            paper = self.__build_model(
+                Paper,
                 pmid=hit["_source"]["pmid"],
                 title=hit["_source"]["title"],
                 score=hit["_score"],
@@ -133,29 +221,59 @@ class Search:
                 authors=[],
             )
             for author_info in hit["_source"]["authors"]:
-                author = Author(**author_info)
-                if author.key() not in self.authors:
-                    author.papers = []
-                    self.authors[author.key()] = author
+                # Only build each author the first time we see them.
+                author_key = f"{author_info['first_name']} {author_info['last_name']}"
+                if author_key in self.authors:
+                    author = self.authors[author_key]
                 else:
-                    author = self.authors[author.key()]
+                    affiliations = [
+                        self.__build_model(Affiliation, **affiliation_info)
+                        for affiliation_info in author_info["affiliations"]
+                    ]
+                    author = self.__build_model(
+                        Author,
+                        **{**author_info, "affiliations": affiliations},
+                        papers=[],
+                    )
+                    self.authors[author_key] = author
                 author.papers.append(paper)
                 paper.authors.append(author)
 
-            self.papers[paper.key()] = paper
+            self.papers[paper.key] = paper
         print(f"done in {datetime.now() - start_models} seconds", flush=True)
 
         # Build the graph
         print("Building graph...", end="", flush=True)
         start_graph = datetime.now()
         self.graph = nx.Graph()
-        for author in self.authors.values():
-            for paper in author.papers:
-                self.graph.add_edge(author.key(), paper.key())
+        self.graph.add_nodes_from(
+            (author.key, {"kind": "author", "size": 100 * len(author.papers)})
+            for author in self.authors.values()
+        )
+        self.graph.add_nodes_from(
+            (paper.key, {"kind": "paper", "size": 500 * paper.score})
+            for paper in self.papers.values()
+            if paper.authors
+        )
+        self.graph.add_edges_from(
+            (author.key, paper.key)
+            for author in self.authors.values()
+            for paper in author.papers
+        )
         print(f"done in {datetime.now() - start_graph} seconds", flush=True)
 
         return
 
+    def __build_model(self, model_class, **fields):
+        """Build a model from the fields, only validating them if requested.
+
+        Without validation, nested models are not built from their fields, so they
+        must be built first and passed in.
+        """
+        if self.validate:
+            return model_class(**fields)
+        return model_class.model_construct(**fields)
+
     def iter_subgraphs(self):
         """Iterate over the subgraphs of the graph."""
         for subgraph in connected_components(self.graph):
@@ -165,22 +283,22 @@ class Search:
         """Plot the given subgraph."""
 
         pos = nx.spring_layout(graph, k=0.5)
-        author_nodes = [a for a in graph.nodes if a in self.authors]
+        author_nodes = [n for n, kind in graph.nodes(data="kind") if kind == "author"]
         nx.draw_networkx_nodes(
             graph,
             pos,
             nodelist=author_nodes,
             node_color="tab:red",
-            node_size=[100 * len(self.authors[a].papers) for a in author_nodes],
+            node_size=[graph.nodes[n]["size"] for n in author_nodes],
             ax=ax,
         )
-        paper_nodes = [p for p in graph.nodes if p in self.papers]
+        paper_nodes = [n for n, kind in graph.nodes(data="kind") if kind == "paper"]
         nx.draw_networkx_nodes(
             graph,
             pos,
             nodelist=paper_nodes,
             node_color="tab:blue",
-            node_size=[500 * self.papers[p] for p in paper_nodes],
+            node_size=[graph.nodes[n]["size"] for n in paper_nodes],
             ax=ax,
         )
         nx.draw_networkx_edges(graph, pos, ax=ax)
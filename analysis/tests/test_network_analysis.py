@@ -0,0 +1,93 @@
+import pytest
+from pytest_mock import MockFixture
+
+from analysis.network_analysis import SOURCE_FIELDS, Affiliation, Author, Paper, Search
+
+AUTHOR_INFO = {
+    "first_name": "Jane",
+    "last_name": "Doe",
+    "initials": "J",
+    "suffix": None,
+    "affiliations": [{"name": "University", "identifiers": []}],
+    "identifier": None,
+}
+
+
+def make_hit(pmid, score, authors):
+    return {
+        "_score": score,
+        "_source": {
+            "pmid": pmid,
+            "title": f"Paper {pmid}",
+            "mesh_annotations": [],
+            "authors": authors,
+        },
+    }
+
+
+HITS = [
+    make_hit("1", 2.0, [AUTHOR_INFO]),
+    make_hit("2", 1.0, [AUTHOR_INFO, {**AUTHOR_INFO, "first_name": "John"}]),
+]
+
+
+@pytest.fixture
+def es_mock(mocker: MockFixture):
+    es = mocker.MagicMock()
+    es.search.return_value = {"hits": {"hits": HITS}}
+    mocker.patch("analysis.network_analysis.get_es_client", return_value=es)
+    return es
+
+
+@pytest.mark.parametrize("validate", [False, True])
+def test_search_models(es_mock, validate):
+    search = Search("cancer", ground_terms=False, validate=validate)
+    assert es_mock.search.called
+
+    assert len(search.papers) == 2
+    assert len(search.authors) == 2
+    for paper in search.papers.values():
+        assert isinstance(paper, Paper)
+        assert all(isinstance(author, Author) for author in paper.authors)
+    for author in search.authors.values():
+        assert isinstance(author, Author)
+        assert all(isinstance(aff, Affiliation) for aff in author.affiliations)
+        assert author.affiliations[0].name == "University"
+        assert all(isinstance(paper, Paper) for paper in author.papers)
+
+    jane = search.authors["Jane Doe"]
+    assert len(jane.papers) == 2
+    assert search.graph.number_of_nodes() == 4
+    assert search.graph.number_of_edges() == 3
+    assert search.graph.nodes[jane.key] == {"kind": "author", "size": 200}
+
+
+def test_search_batch(es_mock):
+    es_mock.msearch.return_value = {
+        "responses": [{"hits": {"hits": HITS}}, {"hits": {"hits": HITS[:1]}}]
+    }
+    searches = Search.batch([("cancer",), ("COVID-19", "asthma")], ground_terms=False)
+    assert es_mock.msearch.call_count == 1
+    assert not es_mock.search.called
+
+    msearch_body = es_mock.msearch.call_args.kwargs["searches"]
+    assert len(msearch_body) == 4
+    assert msearch_body[1]["_source"] == SOURCE_FIELDS
+    assert len(msearch_body[3]["query"]["bool"]["should"]) == 2
+
+    assert [search.search_terms for search in searches] == [
+        ("cancer",),
+        ("COVID-19", "asthma"),
+    ]
+    assert [len(search.papers) for search in searches] == [2, 1]
+    assert all(search.validate is False for search in searches)
+
+
+@pytest.mark.parametrize(
+    "responses",
+    [[{"hits": {"hits": HITS}}], [{"hits": {"hits": HITS}}, {"error": "boom"}]],
+)
+def test_search_batch_failed(es_mock, responses):
+    es_mock.msearch.return_value = {"responses": responses}
+    with pytest.raises(ValueError):
+        Search.batch([("cancer",), ("asthma",)], ground_terms=False)
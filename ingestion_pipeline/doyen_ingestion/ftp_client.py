@@ -1,16 +1,29 @@
 import ftplib
+import json
 import logging
+import tempfile
+import threading
+import time
 import xml.etree.ElementTree as ET
-import zlib
-from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from functools import partial
 from io import BytesIO
 from pathlib import Path
-from typing import List, Tuple, Union
+from typing import Iterator, List, Tuple, Union
+
+from isal import isal_zlib
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
-FTP_BLOCK_SIZE = 33554432  # Chunk size recommended by NCBI
+# The most bytes read from the data connection at a time. Larger reads only cost
+# time allocating (and shrinking) buffers the socket never fills.
+FTP_BLOCK_SIZE = 131072
+
+# Where directory listings are cached, and for how long (in seconds) they are reused.
+LIST_CACHE_DIR = Path("~/.doyen/cache").expanduser()
+LIST_CACHE_TTL = 3600
 
 
 @contextmanager
@@ -18,12 +31,27 @@ def ftp_connection(ftp_url: str):
     """Get an FTP connection for the given URL and login."""
     ftp_session = ftplib.FTP(ftp_url)
     ftp_session.login()
-    yield ftp_session
+    try:
+        yield ftp_session
+    finally:
+        ftp_session.close()
+
+
+def _local_file_name(file_path: Union[Path, str], decompress: bool) -> str:
+    """Get the name to save a file as, dropping the .gz suffix if decompressing."""
+    file_name = Path(file_path).name
+    if decompress and file_name.endswith(".gz"):
+        file_name = file_name[: -len(".gz")]
+    return file_name
 
 
 class NihFtpClient(object):
     """High level access to the NIH FTP repositories.
 
+    The client keeps a single FTP session open, and reuses it for every request, so
+    it should be closed when it is no longer needed, either with `close` or by using
+    the client as a context manager. A client should not be shared between threads.
+
     Parameters
     ----------
     root : Path
@@ -36,8 +64,44 @@ class NihFtpClient(object):
         if not isinstance(root, Path):
             root = Path(root)
         self.root = root
+        self._ftp = None
         return
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """Close the FTP session, if one is open."""
+        if self._ftp is not None:
+            self._ftp.close()
+            self._ftp = None
+        return
+
+    @contextmanager
+    def _session(self):
+        """Use the persistent FTP session, (re)connecting if needed.
+
+        If anything goes wrong while the session is in use, it is closed, so that the
+        next request starts from a fresh session rather than one in an unknown state.
+        """
+        if self._ftp is not None:
+            try:
+                self._ftp.voidcmd("NOOP")
+            except ftplib.all_errors:
+                # The server has most likely dropped the idle session.
+                self.close()
+        if self._ftp is None:
+            self._ftp = ftplib.FTP(self.ftp_url)
+            self._ftp.login()
+        try:
+            yield self._ftp
+        except BaseException:
+            self.close()
+            raise
+
     def get_xml_tree(self, file_name):
         """Get the content from an xml file as an ElementTree."""
         logger.info(f"Downloading {file_name}")
@@ -45,21 +109,133 @@ class NihFtpClient(object):
         logger.info("Parsing XML metadata")
         return ET.XML(xml_bytes)
 
-    def download_file(self, file_path: Union[Path, str], dest_file: Path = None):
-        """Download a file into a file given by file_path."""
+    def iter_xml_elements(
+        self, file_path: Union[Path, str], tag: str
+    ) -> Iterator[ET.Element]:
+        """Iterate over the elements with the given tag in an xml file.
+
+        The file is decompressed and parsed as it downloads, and each element is cleared
+        once the next one is requested, so neither the file nor the full tree is ever
+        held in memory.
+        """
+        logger.info(f"Streaming {tag} elements from {file_path}")
+        if str(file_path).endswith(".gz"):
+            inflater = isal_zlib.decompressobj(16 + isal_zlib.MAX_WBITS)
+        else:
+            inflater = None
+        parser = ET.XMLPullParser(events=("end",))
+
+        def iter_parsed_elements():
+            for _, element in parser.read_events():
+                if element.tag == tag:
+                    yield element
+                    element.clear()
+
+        with self._session() as ftp:
+            for chunk in self._iter_chunks(ftp, file_path):
+                parser.feed(inflater.decompress(chunk) if inflater else chunk)
+                yield from iter_parsed_elements()
+        if inflater:
+            parser.feed(inflater.flush())
+        parser.close()
+        yield from iter_parsed_elements()
+
+    def download_file(
+        self, file_path: Union[Path, str], dest_file: Path = None, decompress=False
+    ):
+        """Download a file into a file given by file_path.
+
+        If decompress is True and the file is gzipped, it is decompressed as it is
+        downloaded, so only the decompressed content is written to dest_file.
+        """
         if not dest_file:
-            dest_file = Path("..") / file_path.name
+            dest_file = Path("..") / _local_file_name(file_path, decompress)
+
+        with self._session() as ftp:
+            self._retrieve_file(ftp, file_path, dest_file, decompress)
+        return
+
+    def download_files(
+        self,
+        file_paths: List[Union[Path, str]],
+        dest_dir: Path,
+        decompress=False,
+        max_workers=8,
+    ):
+        """Download several files into dest_dir in parallel.
 
+        Each worker thread opens its own FTP session, and reuses it for all the files
+        it downloads. If a download fails, the files that have not started yet are
+        cancelled, and the error is raised.
+        """
+        thread_sessions = threading.local()
+        with ExitStack() as session_stack:
+
+            def download_one(file_path):
+                if getattr(thread_sessions, "ftp", None) is None:
+                    thread_sessions.ftp = session_stack.enter_context(
+                        ftp_connection(self.ftp_url)
+                    )
+                dest_file = dest_dir / _local_file_name(file_path, decompress)
+                try:
+                    self._retrieve_file(
+                        thread_sessions.ftp, file_path, dest_file, decompress
+                    )
+                except BaseException:
+                    # Don't reuse a session left in an unknown state.
+                    thread_sessions.ftp.close()
+                    thread_sessions.ftp = None
+                    raise
+
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = [
+                    executor.submit(download_one, file_path) for file_path in file_paths
+                ]
+                try:
+                    for future in futures:
+                        future.result()
+                except BaseException:
+                    # Don't wait for the rest of the downloads before raising.
+                    for future in futures:
+                        future.cancel()
+                    raise
+        return
+
+    def _iter_chunks(
+        self, ftp: ftplib.FTP, file_path: Union[Path, str]
+    ) -> Iterator[bytes]:
+        """Iterate over the raw chunks of a file as they arrive over an FTP session."""
+        full_path = self.root / file_path
+        ftp.voidcmd("TYPE I")
+        with ftp.transfercmd(f"RETR {full_path.as_posix()}") as conn:
+            yield from iter(partial(conn.recv, FTP_BLOCK_SIZE), b"")
+        ftp.voidresp()
+
+    def _retrieve_file(
+        self,
+        ftp: ftplib.FTP,
+        file_path: Union[Path, str],
+        dest_file: Path,
+        decompress: bool,
+    ):
+        """Retrieve a file over an open FTP session into dest_file."""
+        decompress = decompress and str(file_path).endswith(".gz")
         full_path = self.root / file_path
         logger.info(full_path)
         with dest_file.open("wb") as gzf:
-            with ftp_connection(self.ftp_url) as ftp:
-                ftp.retrbinary(
-                    f"RETR {full_path.as_posix()}",
-                    callback=lambda s: gzf.write(s),
-                    blocksize=FTP_BLOCK_SIZE,
-                )
-                gzf.flush()
+            if decompress:
+                inflater = isal_zlib.decompressobj(16 + isal_zlib.MAX_WBITS)
+                write_chunk = lambda s: gzf.write(inflater.decompress(s))
+            else:
+                write_chunk = gzf.write
+            ftp.retrbinary(
+                f"RETR {full_path.as_posix()}",
+                callback=write_chunk,
+                blocksize=FTP_BLOCK_SIZE,
+            )
+            if decompress:
+                gzf.write(inflater.flush())
+            gzf.flush()
         return
 
     def get_file(self, file_path: Union[Path, str], force_str=True, decompress=True):
@@ -67,17 +243,17 @@ class NihFtpClient(object):
 
         full_path = self.root / file_path
         gzf_bytes = BytesIO()
-        with ftp_connection(self.ftp_url) as ftp:
+        with self._session() as ftp:
             ftp.retrbinary(
                 f"RETR {full_path.as_posix()}",
-                callback=lambda s: gzf_bytes.write(s),
+                callback=gzf_bytes.write,
                 blocksize=FTP_BLOCK_SIZE,
             )
             gzf_bytes.flush()
         ret = gzf_bytes.getvalue()
 
         if file_path.endswith(".gz") and decompress:
-            ret = zlib.decompress(ret, 16 + zlib.MAX_WBITS)
+            ret = isal_zlib.decompress(ret, 16 + isal_zlib.MAX_WBITS)
 
         if force_str and isinstance(ret, bytes):
             ret = ret.decode("utf8")
@@ -86,14 +262,14 @@ class NihFtpClient(object):
 
     def list(
         self, dir_path: Union[Path, str] = None, with_timestamps=True
-    ) -> List[Tuple[str, int]]:
+    ) -> Union[List[Tuple[str, str]], List[str]]:
         """List all contents the ftp directory."""
         if dir_path is None:
             dir_path = self.root
         else:
             dir_path = self.root / dir_path
 
-        with ftp_connection(self.ftp_url) as ftp:
+        with self._session() as ftp:
             if with_timestamps:
                 raw_contents = ftp.mlsd(dir_path.as_posix())
                 contents = [
@@ -104,3 +280,43 @@ class NihFtpClient(object):
             else:
                 contents = ftp.nlst()
         return contents
+
+    def list_cached(
+        self,
+        dir_path: Union[Path, str] = None,
+        with_timestamps=True,
+        ttl: float = LIST_CACHE_TTL,
+        cache_dir: Path = None,
+    ) -> Union[List[Tuple[str, str]], List[str]]:
+        """List the contents of the ftp directory, reusing a recent listing if possible.
+
+        Listing a large directory takes a long time, so the listing is cached on disk
+        in `cache_dir` (by default LIST_CACHE_DIR), and reused for up to `ttl` seconds.
+        """
+        if cache_dir is None:
+            cache_dir = LIST_CACHE_DIR
+        full_path = self.root if dir_path is None else self.root / dir_path
+        cache_name = "_".join([self.ftp_url, *full_path.parts])
+        if with_timestamps:
+            cache_name += "_timestamps"
+        cache_file = cache_dir / f"{cache_name}.json"
+
+        if cache_file.exists() and time.time() - cache_file.stat().st_mtime < ttl:
+            logger.info(f"Using the cached listing of {full_path}")
+            with cache_file.open() as file_handle:
+                contents = json.load(file_handle)
+            if with_timestamps:
+                contents = [tuple(entry) for entry in contents]
+            return contents
+
+        contents = self.list(dir_path, with_timestamps=with_timestamps)
+
+        # Write the listing to a temporary file first, so that another run never reads
+        # a partly written listing.
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            "w", dir=cache_dir, suffix=".tmp", delete=False
+        ) as file_handle:
+            json.dump(contents, file_handle)
+        Path(file_handle.name).replace(cache_file)
+        return contents
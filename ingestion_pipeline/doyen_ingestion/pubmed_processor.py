@@ -1,17 +1,31 @@
 import configparser
 import json
 import logging
+import multiprocessing
+import os
 import shutil
+import xml.etree.ElementTree as ET
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
-from typing import List, Optional
+from typing import Iterator, List, Optional, Tuple
 
 import click
 import elasticsearch
+import orjson
 from elasticsearch import helpers
-from indra.literature.pubmed_client import get_metadata_from_xml_tree
+from indra.literature.pubmed_client import get_metadata_from_pubmed_article
 
-from doyen_ingestion.ftp_client import NihFtpClient
+from doyen_ingestion.ftp_client import LIST_CACHE_TTL, NihFtpClient
+
+try:
+    from elasticsearch.serializer import OrjsonSerializer
+except ImportError:
+    # elasticsearch-py only re-exports the transport's serializer from 8.13.
+    from elastic_transport import OrjsonSerializer
 
 # Define file paths relative to this location.
 HERE = Path(__file__).parent.absolute()
@@ -24,6 +38,32 @@ if not CONFIG_FILE.exists():
 CONFIG_TEMPLATE = HERE / "resources" / "config_template.ini"
 ES_INDEX_CONFIG = HERE / "resources" / "elastic-search-config.json"
 
+# The number of HTTP connections the elasticsearch client keeps open to each node.
+ES_CONNECTIONS_PER_NODE = 32
+
+# How many times a request that times out, or fails to connect, is retried. Retrying
+# a bulk request is safe, since the articles are indexed under their PMIDs.
+ES_MAX_RETRIES = 3
+
+# Bulk indexing is spread over several threads, each sending requests of up to
+# BULK_CHUNK_SIZE articles or BULK_MAX_CHUNK_BYTES bytes, whichever is smaller.
+# These defaults can be overridden in the [elasticsearch] section of the config.
+BULK_CHUNK_SIZE = 1000
+BULK_MAX_CHUNK_BYTES = 10 * 1024 * 1024
+BULK_THREAD_COUNT = 4
+BULK_QUEUE_SIZE = 4
+
+# The index settings used while bulk loading (see bulk_load_settings).
+BULK_LOAD_SETTINGS = {
+    "index.refresh_interval": "-1",
+    "index.number_of_replicas": 0,
+    "index.translog.flush_threshold_size": "1gb",
+}
+
+# The statuses of the dates in an article's history, in order of preference for its
+# publication date. This is the same preference indra uses.
+PUB_DATE_STATUSES = ("pubmed", "accepted", "revised", "received", "entrez")
+
 # Create a logger with nice time stamps.
 logging.basicConfig(
     level=logging.INFO, format=f"[%(asctime)s] %(name)s %(levelname)s - %(message)s"
@@ -48,8 +88,13 @@ CONFIG = configparser.ConfigParser()
 CONFIG.read(CONFIG_FILE)
 
 
+@lru_cache(maxsize=1)
 def get_es_client():
-    """Get an instance of the elasticsearch client."""
+    """Get the shared instance of the elasticsearch client.
+
+    The client is built once and reused, so that its pool of keep-alive connections
+    is shared by every caller. The client is thread safe.
+    """
     verify_certs_str = CONFIG.get("elasticsearch", "verify_certs")
     if verify_certs_str.lower() not in ("true", "false"):
         raise ValueError(
@@ -60,6 +105,13 @@ def get_es_client():
     return elasticsearch.Elasticsearch(
         CONFIG.get("elasticsearch", "host"),
         verify_certs=verify_certs,
+        connections_per_node=ES_CONNECTIONS_PER_NODE,
+        http_compress=True,
+        retry_on_timeout=True,
+        max_retries=ES_MAX_RETRIES,
+        # The bulk helpers serialize every action and article with the client's JSON
+        # serializer, and orjson is much faster than the json module.
+        serializers={OrjsonSerializer.mimetype: OrjsonSerializer()},
         ca_certs=CONFIG.get("elasticsearch", "ca_certs"),
         basic_auth=(
             CONFIG.get("elasticsearch", "username"),
@@ -83,7 +135,11 @@ def create_pubmed_paper_index():
 
     # Build the index.
     try:
-        es.indices.create(index=index_name, body={"mappings": es_config["mappings"]})
+        es.indices.create(
+            index=index_name,
+            settings=es_config["settings"],
+            mappings=es_config["mappings"],
+        )
     except elasticsearch.BadRequestError as err:
         logger.error("Failed to create the index.")
         logger.exception(err)
@@ -92,97 +148,306 @@ def create_pubmed_paper_index():
     return True
 
 
+@contextmanager
+def bulk_load_settings(
+    es: elasticsearch.Elasticsearch, index_name: str, forcemerge: bool = False
+):
+    """Disable refreshes and replicas of an index while bulk loading it.
+
+    Refreshing the index and copying documents to replicas is wasted work while the
+    index is still being written to, so both are turned off until the context exits,
+    and the translog is allowed to grow larger before it is flushed. The original
+    settings are then restored. If the index does not exist yet, it is left to be
+    created by the bulk requests, with default settings.
+
+    If forcemerge is True, the index is also merged down to a few segments in the
+    background. Only do this for an index that was built from scratch and will not
+    be written to again soon: force merged segments are too large for regular merges
+    to pick up, so the documents later deleted from them are never cleaned up.
+    """
+    if not es.indices.exists(index=index_name):
+        logger.warning(
+            f"The index {index_name} does not exist, so it will be created with "
+            f"default settings and mappings, untuned for bulk loading."
+        )
+        yield
+        return
+
+    index_settings = es.indices.get_settings(
+        index=index_name, flat_settings=True, include_defaults=True
+    )[index_name]
+    original_settings = {
+        key: index_settings["settings"].get(key, index_settings["defaults"].get(key))
+        for key in BULK_LOAD_SETTINGS
+    }
+    es.indices.put_settings(index=index_name, settings=BULK_LOAD_SETTINGS)
+    try:
+        yield
+    finally:
+        # Don't let a failure here hide any error raised while loading.
+        try:
+            es.indices.put_settings(index=index_name, settings=original_settings)
+        except (elasticsearch.ApiError, elasticsearch.TransportError) as err:
+            logger.error(
+                f"Failed to restore the settings of {index_name} after bulk loading. "
+                f"They should be set back to {original_settings} by hand."
+            )
+            logger.exception(err)
+        if forcemerge:
+            try:
+                es.indices.forcemerge(
+                    index=index_name, max_num_segments=5, wait_for_completion=False
+                )
+            except (elasticsearch.ApiError, elasticsearch.TransportError) as err:
+                logger.error(f"Failed to start force merging {index_name}.")
+                logger.exception(err)
+
+
+def _get_publication_date(
+    pubmed_article: ET.Element,
+) -> Optional[Tuple[int, Optional[int], Optional[int]]]:
+    """Get the year, month and day an article was published, if its year is known."""
+    dates_by_status = {}
+    for pub_date in pubmed_article.iterfind("PubmedData/History/PubMedPubDate"):
+        dates_by_status.setdefault(pub_date.get("PubStatus"), pub_date)
+    for status in PUB_DATE_STATUSES:
+        if status in dates_by_status:
+            pub_date = dates_by_status[status]
+            break
+    else:
+        return None
+
+    year, month, day = (
+        pub_date.findtext(date_part) for date_part in ("Year", "Month", "Day")
+    )
+    if not year:
+        return None
+    return int(year), month and int(month), day and int(day)
+
+
+@lru_cache(maxsize=4096)
+def _format_date(year: int, month: int, day: int) -> str:
+    """Format a publication date for ElasticSearch, e.g. 2023-01-31.
+
+    Many articles in a file share a publication date, so each date is only
+    formatted once.
+    """
+    return f"{year:04d}-{month:02d}-{day:02d}"
+
+
+@lru_cache(maxsize=1)
+def _get_metadata_options() -> dict:
+    """Get the options for extracting article metadata, based on the index mapping.
+
+    The optional parts of the metadata are only extracted if the index maps them.
+    """
+    with ES_INDEX_CONFIG.open() as file_handle:
+        properties = json.load(file_handle)["mappings"]["properties"]
+    author_properties = properties.get("authors", {}).get("properties", {})
+    return {
+        "get_abstracts": "abstract" in properties,
+        "mesh_annotations": "mesh_annotations" in properties,
+        "prepend_title": True,
+        "detailed_authors": "first_name" in author_properties,
+        "references_included": "pmid" if "references" in properties else None,
+    }
+
+
+@lru_cache(maxsize=1)
+def _get_pubmed_ftp_client() -> NihFtpClient:
+    """Get the FTP client this process uses to download PubMed files."""
+    return NihFtpClient("pubmed")
+
+
+def extract_recent_articles(file_path: str, min_year: int) -> List[dict]:
+    """Download and parse a PubMed file, returning its articles newer than min_year.
+
+    The articles are returned as bulk index actions, with the PMID as the document ID
+    and the article already serialized to JSON as the source, so that the indexing
+    process only has to send them on. The publication dates are formatted for
+    ElasticSearch.
+    """
+    client = _get_pubmed_ftp_client()
+
+    # Parse the XML, one article at a time.
+    articles_by_pmid = {}
+    for pubmed_article in client.iter_xml_elements(file_path, "PubmedArticle"):
+        # Check the date before extracting anything else, since most articles in a
+        # baseline file are too old to be indexed.
+        # NOTE: we are skipping publications without a publication date. Based on
+        # manual inspection, these appear to be pre-prints.
+        pub_date = _get_publication_date(pubmed_article)
+        if pub_date is None or pub_date[0] <= min_year:
+            # This version of the article still replaces any earlier one.
+            pmid = pubmed_article.findtext("MedlineCitation/PMID")
+            articles_by_pmid.pop(pmid, None)
+            continue
+
+        article = get_metadata_from_pubmed_article(
+            pubmed_article, **_get_metadata_options()
+        )
+        article["publication_date"] = _format_date(*pub_date)
+        articles_by_pmid[article["pmid"]] = article
+
+    # Index the articles under their PMIDs, so that later versions replace them.
+    return [
+        {"_id": pmid, "_source": orjson.dumps(article)}
+        for pmid, article in articles_by_pmid.items()
+    ]
+
+
+def _iter_recent_articles(
+    file_paths: List[str],
+    min_year: int,
+    workers: int,
+    mp_context: Optional[multiprocessing.context.BaseContext] = None,
+) -> Iterator[Tuple[str, List[dict]]]:
+    """Iterate over the recent articles of each file, in order.
+
+    The files are downloaded and parsed by a pool of worker processes, started with
+    mp_context (by default, the default start method), so that the next files are
+    parsed while the current one is indexed. At most one file per worker is parsed
+    ahead, so the parsed articles do not pile up in memory if indexing is slow.
+    """
+    if workers <= 1:
+        for file_path in file_paths:
+            yield file_path, extract_recent_articles(file_path, min_year)
+        return
+
+    # Make sure forked workers open their own FTP sessions.
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=mp_context,
+        initializer=_get_pubmed_ftp_client.cache_clear,
+    ) as executor:
+        pending = deque()
+        for file_path in file_paths:
+            future = executor.submit(extract_recent_articles, file_path, min_year)
+            pending.append((file_path, future))
+            # Keep every worker busy while the oldest file is being indexed.
+            if len(pending) > workers:
+                done_path, done_future = pending.popleft()
+                yield done_path, done_future.result()
+        for done_path, done_future in pending:
+            yield done_path, done_future.result()
+
+
 def index_pubmed_files(
     file_paths: List[str],
     min_year=None,
     refresh_index: bool = True,
+    workers: Optional[int] = None,
+    mp_context: Optional[multiprocessing.context.BaseContext] = None,
 ):
-    """Indexes all the gz files in the provided list_of_files parameter"""
+    """Indexes all the gz files in the provided list_of_files parameter
+
+    The files are downloaded and parsed in parallel by `workers` processes, which
+    defaults to the number of CPUs, started with the `mp_context` multiprocessing
+    context, which defaults to the default start method. Refreshes and replicas of the index are disabled
+    while the files are indexed (see `bulk_load_settings`), so newly indexed articles
+    only become searchable once all the files are done. If the index was rebuilt, it
+    is also force merged once the files are done.
+    """
     start = datetime.now()
 
     if refresh_index:
         logger.info("Rebuilding the index...")
-        create_pubmed_paper_index()
+        if not create_pubmed_paper_index():
+            logger.error("Could not build the index, so no files will be indexed.")
+            return
 
-    client = NihFtpClient("pubmed")
+    index_name = CONFIG.get("index", "name")
+    timeout = int(CONFIG.get("elasticsearch", "timeout"))
     es = get_es_client()
+    bulk_es = es.options(request_timeout=timeout)
+    bulk_options = dict(
+        chunk_size=CONFIG.getint(
+            "elasticsearch", "chunk_size", fallback=BULK_CHUNK_SIZE
+        ),
+        max_chunk_bytes=CONFIG.getint(
+            "elasticsearch", "max_chunk_bytes", fallback=BULK_MAX_CHUNK_BYTES
+        ),
+        thread_count=CONFIG.getint(
+            "elasticsearch", "thread_count", fallback=BULK_THREAD_COUNT
+        ),
+        queue_size=CONFIG.getint(
+            "elasticsearch", "queue_size", fallback=BULK_QUEUE_SIZE
+        ),
+    )
+    if workers is None:
+        workers = os.cpu_count()
 
     # Loop over all files, extract the information and index in bulk
     files_indexed = 0
     articles_added = 0
-    for i, file_path in enumerate(file_paths):
-        logger.info(f"Processing file {i} of {len(file_paths)}: {file_path}")
-        start_file = datetime.now()
-
-        # Parse the XML
-        xml_tree = client.get_xml_tree(file_path)
-        articles_by_pmid = get_metadata_from_xml_tree(
-            xml_tree,
-            get_abstracts=True,
-            mesh_annotations=True,
-            prepend_title=True,
-            detailed_authors=True,
-            references_included="pmid",
-        )
-
-        # NOTE: we are skipping publications without a publication date. Based on
-        # manual inspection, these appear to be pre-prints.
-        recent_articles = [
-            article
-            for article in articles_by_pmid.values()
-            if article["publication_date"]["year"]
-            and article["publication_date"]["year"] > min_year
-        ]
-        xml_tree.clear()
-
-        # Update the date format.
-        for article in recent_articles:
-            pub_date = article["publication_date"]
-            article["publication_date"] = datetime(
-                year=pub_date["year"], month=pub_date["month"], day=pub_date["day"]
-            ).strftime("%Y-%m-%d")
-
-        # Make sure we didn't filter out all the articles.
-        if not recent_articles:
-            logger.info(f"No recent articles found in {file_path}, continuing...")
-            continue
-
-        # Try to upload all these articles into ElasticSearch
-        logger.info(f"Starting to index {len(recent_articles)} articles...")
-        start_index = datetime.now()
-        try:
-            for is_ok, response in helpers.streaming_bulk(
-                es,
-                recent_articles,
-                index=CONFIG.get("index", "name"),
-                raise_on_error=True,
-                request_timeout=int(CONFIG.get("elasticsearch", "timeout")),
-            ):
-                if not is_ok:
-                    # If the indexing is not successful, log the error
-                    identifier = response["create"]["_id"]
-                    error = response["create"]["error"]
-                    logger.error(f"Error processing document ID {identifier}")
-                    logger.error(json.dumps(error, indent=4, ensure_ascii=False))
-        except Exception as err:
-            logger.error(f"Failed to add documents from {file_path}: {err}")
-            logger.exception(err)
-            continue
-
-        total_time_taken_per_file = datetime.now() - start_file
-        indexing_time_taken_per_file = datetime.now() - start_index
-        logger.info(
-            f"Completed file {i} of {len(file_paths)}, {file_path}, "
-            f"in {total_time_taken_per_file} total, and {indexing_time_taken_per_file}"
-        )
-
-        files_indexed += 1
-        articles_added += len(recent_articles)
+    articles_failed = 0
+    recent_articles_by_file = _iter_recent_articles(
+        file_paths, min_year, workers, mp_context
+    )
+    with bulk_load_settings(es, index_name, forcemerge=refresh_index):
+        for i, (file_path, recent_articles) in enumerate(recent_articles_by_file):
+            logger.info(f"Processing file {i} of {len(file_paths)}: {file_path}")
+            start_file = datetime.now()
+
+            # Make sure we didn't filter out all the articles.
+            if not recent_articles:
+                logger.info(f"No recent articles found in {file_path}, continuing...")
+                continue
+
+            # Try to upload all these articles into ElasticSearch
+            logger.info(f"Starting to index {len(recent_articles)} articles...")
+            start_index = datetime.now()
+            file_articles_failed = 0
+            try:
+                for is_ok, response in helpers.parallel_bulk(
+                    bulk_es,
+                    recent_articles,
+                    index=index_name,
+                    raise_on_error=False,
+                    **bulk_options,
+                ):
+                    if is_ok:
+                        articles_added += 1
+                    else:
+                        file_articles_failed += 1
+                        # If the indexing is not successful, log the error
+                        _, result = response.popitem()
+                        identifier = result["_id"]
+                        error = result["error"]
+                        if logger.isEnabledFor(logging.ERROR):
+                            logger.error(f"Error processing document ID {identifier}")
+                            logger.error(
+                                orjson.dumps(error, option=orjson.OPT_INDENT_2).decode()
+                            )
+            except Exception as err:
+                logger.error(f"Failed to add documents from {file_path}: {err}")
+                logger.exception(err)
+                continue
+            finally:
+                articles_failed += file_articles_failed
+
+            if file_articles_failed:
+                logger.warning(
+                    f"Failed to index {file_articles_failed} of {len(recent_articles)} "
+                    f"articles from {file_path}."
+                )
+                continue
+
+            total_time_taken_per_file = datetime.now() - start_file
+            indexing_time_taken_per_file = datetime.now() - start_index
+            logger.info(
+                f"Completed file {i} of {len(file_paths)}, {file_path}, "
+                f"in {total_time_taken_per_file} total, and {indexing_time_taken_per_file}"
+            )
+
+            files_indexed += 1
 
     total_time_taken = datetime.now() - start
     logger.info(
         f"Successfully index {files_indexed} files, adding {articles_added} articles in {total_time_taken}."
     )
+    if articles_failed:
+        logger.warning(f"Failed to index {articles_failed} articles.")
 
 
 @click.command()
@@ -235,6 +500,19 @@ def index_pubmed_files(
     is_flag=True,
     help="Optionally do not refresh the index before indexing the files.",
 )
+@click.option(
+    "--workers",
+    "-w",
+    default=None,
+    help="The number of processes used to download and parse files in parallel. "
+    "Defaults to the number of CPUs.",
+    type=int,
+)
+@click.option(
+    "--refresh-file-lists",
+    is_flag=True,
+    help="List the files on the FTP server again, even if they were listed recently.",
+)
 def doyen_ingest_cli(
     start: Optional[int],
     end: Optional[int],
@@ -243,6 +521,8 @@ def doyen_ingest_cli(
     updatefiles_only: bool,
     min_year: int,
     no_refresh_index: bool,
+    workers: Optional[int],
+    refresh_file_lists: bool,
 ):
     """This CLI helps manage building indexes of the PubMed baseline and update files into ElasticSearch.
 
@@ -257,20 +537,21 @@ def doyen_ingest_cli(
         logging.basicConfig(level=logging.WARNING)
 
     # Get the list of candidate files
-    client = NihFtpClient("pubmed")
+    list_cache_ttl = 0 if refresh_file_lists else LIST_CACHE_TTL
     candidate_files = []
-    if not updatefiles_only:
-        candidate_files += sorted(
-            f"baseline/{fname}"
-            for fname, _ in client.list("baseline")
-            if fname.endswith(".gz")
-        )
-    if not baseline_only:
-        candidate_files += sorted(
-            f"updatefiles/{fname}"
-            for fname, _ in client.list("updatefiles")
-            if fname.endswith(".gz")
-        )
+    with NihFtpClient("pubmed") as client:
+        if not updatefiles_only:
+            candidate_files += sorted(
+                f"baseline/{fname}"
+                for fname, _ in client.list_cached("baseline", ttl=list_cache_ttl)
+                if fname.endswith(".gz")
+            )
+        if not baseline_only:
+            candidate_files += sorted(
+                f"updatefiles/{fname}"
+                for fname, _ in client.list_cached("updatefiles", ttl=list_cache_ttl)
+                if fname.endswith(".gz")
+            )
 
     # If the year is negative, we need to get the year relative to the current year.
     if min_year < 0:
@@ -293,6 +574,7 @@ def doyen_ingest_cli(
         files_to_index,
         min_year=min_year,
         refresh_index=not no_refresh_index,
+        workers=workers,
     )
 
 
@@ -1,11 +1,24 @@
+import gzip
+import logging
+import multiprocessing
+import time
+import xml.etree.ElementTree as ET
 from io import BytesIO
 
+import elasticsearch
 import pytest
 from click.testing import CliRunner
 from elasticsearch import Elasticsearch
 from pytest_mock import MockFixture
 
-from doyen_ingestion.pubmed_processor import CONFIG, doyen_ingest_cli
+from doyen_ingestion.ftp_client import NihFtpClient
+from doyen_ingestion.pubmed_processor import (
+    CONFIG,
+    _get_publication_date,
+    doyen_ingest_cli,
+    get_es_client,
+    index_pubmed_files,
+)
 
 
 @pytest.fixture
@@ -23,11 +36,12 @@ def es_mock(mocker: MockFixture):
     es.bulk.side_effect = lambda *args, **kwargs: None
 
     mocker.patch("elasticsearch.Elasticsearch", return_value=es)
+    get_es_client.cache_clear()
     return es
 
 
 @pytest.fixture
-def ftp_mock(mocker: MockFixture):
+def ftp_mock(mocker: MockFixture, tmp_path):
     # Read in the contents of the local gzipped XML file
     with open("pubmed_sample.xml.gz", "rb") as f:
         xml_data = f.read()
@@ -47,12 +61,25 @@ def ftp_mock(mocker: MockFixture):
 
     ftp_mock.retrbinary.side_effect = mock_retrbinary
 
+    # Mock the FTP object's transfercmd() method to stream the contents of the local XML file
+    def mock_transfercmd(cmd, **kwargs):
+        stream = BytesIO(xml_data)
+        conn_mock = mocker.MagicMock()
+        conn_mock.__enter__.return_value = conn_mock
+        conn_mock.recv.side_effect = stream.read
+        return conn_mock
+
+    ftp_mock.transfercmd.side_effect = mock_transfercmd
+
     # Mock the FTP object's list() method to return a list of files
     ftp_mock.nlst.return_value = ["pubmed_sample.xml.gz"]
     ftp_mock.mlsd.return_value = [("pubmed_sample.xml.gz", {"modify": 123459879})]
 
     mocker.patch("ftplib.FTP", return_value=ftp_mock)
 
+    # Don't reuse, or leave behind, cached listings.
+    mocker.patch("doyen_ingestion.ftp_client.LIST_CACHE_DIR", tmp_path)
+
     # Return the FTP mock
     return ftp_mock
 
@@ -63,11 +90,149 @@ def runner():
 
 
 def test_upload(es_mock, ftp_mock, runner):
-    result = runner.invoke(doyen_ingest_cli)
+    result = runner.invoke(doyen_ingest_cli, ["--workers", "1"])
     assert result.exit_code == 0, result.return_value
     assert ftp_mock.mlsd.called
-    assert ftp_mock.retrbinary.called
+    assert ftp_mock.transfercmd.called
     assert es_mock.indices.exists.called
     assert es_mock.indices.create.called
     assert es_mock.options.called
     assert len(es_mock.options.mock_calls) > 10
+    assert es_mock.indices.forcemerge.called
+
+
+def test_upload_without_refresh(es_mock, ftp_mock, runner):
+    result = runner.invoke(doyen_ingest_cli, ["--workers", "1", "--no-refresh-index"])
+    assert result.exit_code == 0, result.output
+    assert not es_mock.indices.create.called
+    assert es_mock.indices.put_settings.call_count == 2
+    assert not es_mock.indices.forcemerge.called
+    assert len(es_mock.options.mock_calls) > 10
+
+
+def test_upload_without_index(es_mock, ftp_mock, runner):
+    es_mock.indices.exists.return_value = False
+    result = runner.invoke(doyen_ingest_cli, ["--workers", "1", "--no-refresh-index"])
+    assert result.exit_code == 0, result.output
+    assert not es_mock.indices.get_settings.called
+    assert not es_mock.indices.put_settings.called
+    assert len(es_mock.options.mock_calls) > 10
+
+
+def test_upload_index_creation_failed(es_mock, ftp_mock, runner, mocker: MockFixture):
+    mocker.patch(
+        "doyen_ingestion.pubmed_processor.create_pubmed_paper_index",
+        return_value=False,
+    )
+    result = runner.invoke(doyen_ingest_cli, ["--workers", "1"])
+    assert result.exit_code == 0, result.output
+    assert not ftp_mock.transfercmd.called
+    assert not es_mock.indices.put_settings.called
+    assert not es_mock.options.return_value.bulk.called
+
+
+def test_upload_restore_settings_failed(es_mock, ftp_mock, runner):
+    es_mock.indices.put_settings.side_effect = [
+        None,
+        elasticsearch.ConnectionError("boom"),
+    ]
+    result = runner.invoke(doyen_ingest_cli, ["--workers", "1"])
+    assert result.exit_code == 0, result.output
+    assert es_mock.indices.put_settings.call_count == 2
+    assert len(es_mock.options.mock_calls) > 10
+
+
+@pytest.mark.skipif(
+    "fork" not in multiprocessing.get_all_start_methods(),
+    reason="The worker processes only inherit the mocks when they are forked.",
+)
+def test_index_parallel(es_mock, ftp_mock):
+    index_pubmed_files(
+        ["baseline/pubmed_sample.xml.gz", "updatefiles/pubmed_sample.xml.gz"],
+        min_year=1900,
+        workers=2,
+        mp_context=multiprocessing.get_context("fork"),
+    )
+    assert es_mock.indices.create.called
+    assert len(es_mock.options.mock_calls) > 10
+
+
+def test_download_files(ftp_mock, tmp_path):
+    file_paths = [f"baseline/pubmed_sample_{i}.xml.gz" for i in range(4)]
+    NihFtpClient("pubmed").download_files(
+        file_paths, tmp_path, decompress=True, max_workers=2
+    )
+    with gzip.open("pubmed_sample.xml.gz") as file_handle:
+        expected = file_handle.read()
+    for i in range(4):
+        assert (tmp_path / f"pubmed_sample_{i}.xml").read_bytes() == expected
+    assert ftp_mock.retrbinary.call_count == 4
+
+
+def test_download_files_failed(ftp_mock, tmp_path):
+    def mock_retrbinary(cmd, callback, **kwargs):
+        if cmd.endswith("bad.xml.gz"):
+            raise EOFError()
+        time.sleep(0.1)
+        callback(b"data")
+
+    ftp_mock.retrbinary.side_effect = mock_retrbinary
+    file_paths = ["bad.xml.gz"] + [f"good_{i}.xml.gz" for i in range(5)]
+    with pytest.raises(EOFError):
+        NihFtpClient("pubmed").download_files(file_paths, tmp_path, max_workers=1)
+
+    # The broken session is closed, and the queued downloads are cancelled.
+    assert ftp_mock.close.called
+    assert ftp_mock.retrbinary.call_count < len(file_paths)
+
+
+def test_list_cached(ftp_mock, tmp_path):
+    client = NihFtpClient("pubmed")
+    expected = [("pubmed_sample.xml.gz", 123459879)]
+    assert client.list_cached("baseline") == expected
+    assert client.list_cached("baseline") == expected
+    assert ftp_mock.mlsd.call_count == 1
+    assert [path.suffix for path in tmp_path.iterdir()] == [".json"]
+
+    # An expired listing is listed again.
+    assert client.list_cached("baseline", ttl=0) == expected
+    assert ftp_mock.mlsd.call_count == 2
+
+
+def test_upload_counts_failures(es_mock, ftp_mock, runner, mocker: MockFixture, caplog):
+    # Fail the first article of every bulk request.
+    def mock_bulk(operations, **kwargs):
+        items = [
+            {"index": {"_id": str(i), "status": 201}}
+            for i in range(len(operations) // 2)
+        ]
+        items[0]["index"].update(status=400, error={"type": "mapper_parsing_exception"})
+        return mocker.MagicMock(body={"errors": True, "items": items})
+
+    es_mock.options.return_value.bulk.side_effect = mock_bulk
+    caplog.set_level(logging.INFO)
+    result = runner.invoke(doyen_ingest_cli, ["--workers", "1"])
+    assert result.exit_code == 0, result.output
+    assert "Successfully index 0 files, adding 18 articles" in caplog.text
+    assert "Failed to index 1 of 10 articles" in caplog.text
+    assert "Failed to index 2 articles." in caplog.text
+
+
+def test_get_publication_date():
+    def make_article(*dates):
+        history = "".join(
+            f'<PubMedPubDate PubStatus="{status}">{parts}</PubMedPubDate>'
+            for status, parts in dates
+        )
+        return ET.XML(
+            f"<PubmedArticle><PubmedData><History>{history}</History></PubmedData>"
+            f"</PubmedArticle>"
+        )
+
+    received = ("received", "<Year>2020</Year><Month>1</Month><Day>2</Day>")
+    pubmed = ("pubmed", "<Year>2021</Year><Month>3</Month><Day>4</Day>")
+    assert _get_publication_date(make_article(received, pubmed)) == (2021, 3, 4)
+    assert _get_publication_date(make_article(received)) == (2020, 1, 2)
+    assert _get_publication_date(make_article(("medline", pubmed[1]))) is None
+    assert _get_publication_date(make_article(("pubmed", "<Month>3</Month>"))) is None
+    assert _get_publication_date(make_article()) is None
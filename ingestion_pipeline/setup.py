@@ -15,6 +15,8 @@ setup(
     install_requires=[
         "click",
         "elasticsearch",
+        "isal",
+        "orjson",
         "indra @ https://github.com/sorgerlab/indra/archive/master.zip",
     ],
     extras_require={"dev": ["pytest", "black", "pytest-mock"]},